@@ -2,6 +2,7 @@ import torch
 import contextlib
 import os
 import math
+import weakref
 
 import comfy.utils
 import comfy.model_management
@@ -9,6 +10,7 @@ from comfy.clip_vision import clip_preprocess
 from comfy.ldm.modules.attention import optimized_attention
 import folder_paths
 
+import safetensors.torch
 from torch import nn
 from PIL import Image
 import torch.nn.functional as F
@@ -16,6 +18,17 @@ import torchvision.transforms as TT
 
 from .resampler import PerceiverAttention, FeedForward, Resampler
 
+try:
+    import torchvision.transforms.v2.functional as TF
+except ImportError:
+    TF = None
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
 # set the models directory backward compatible
 GLOBAL_MODELS_DIR = os.path.join(folder_paths.models_dir, "ipadapter")
 MODELS_DIR = GLOBAL_MODELS_DIR if os.path.isdir(GLOBAL_MODELS_DIR) else os.path.join(os.path.dirname(os.path.realpath(__file__)), "models")
@@ -27,6 +40,16 @@ folder_paths.folder_names_and_paths["ipadapter"] = (current_paths, folder_paths.
 
 INSIGHTFACE_DIR = os.path.join(folder_paths.models_dir, "insightface")
 
+# opt-in torch.compile of the image projection models. The first compilation of each architecture
+# takes longer than many eager runs, it pays off only when the same kind of model is applied often.
+# The compiled models are kept for the life of the process, on the offload device between applies
+TORCH_COMPILE = os.environ.get("IPADAPTER_TORCH_COMPILE", "0") == "1" and hasattr(torch, "compile")
+compiled_proj_models = {}
+
+# opt-in low precision weights for small GPUs: the image projection model is stored in float8 and the
+# IP k/v layers in int8. It saves VRAM but slightly changes the results, so it's never enabled by default
+QUANTIZE_WEIGHTS = os.environ.get("IPADAPTER_QUANTIZE", "0") == "1"
+
 class FacePerceiverResampler(torch.nn.Module):
     def __init__(
         self,
@@ -146,26 +169,128 @@ class ImageProjModel(nn.Module):
         clip_extra_context_tokens = self.norm(clip_extra_context_tokens)
         return clip_extra_context_tokens
 
+class QuantizedLinear(nn.Module):
+    ''' nn.Linear with the weight stored in int8 or float8, dequantized on the fly '''
+    def __init__(self, weight, bias=None, dtype=torch.int8):
+        super().__init__()
+        self.weight_dtype = dtype
+        self.in_features = weight.shape[1]
+        self.out_features = weight.shape[0]
+
+        weight = weight.float()
+        if dtype == torch.int8:
+            # one scale per output channel
+            scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / 127.0
+            qweight = torch.round(weight / scale).clamp(-127, 127).to(torch.int8)
+        else:
+            # one scale per tensor, float8 is stored as uint8 otherwise module.to(dtype) would convert it back
+            scale = weight.abs().amax().clamp(min=1e-12) / torch.finfo(dtype).max
+            qweight = (weight / scale).to(dtype).view(torch.uint8)
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("scale", scale)
+        self.bias = nn.Parameter(bias, requires_grad=False) if bias is not None else None
+
+    def forward(self, x):
+        qweight = self.qweight if self.weight_dtype == torch.int8 else self.qweight.view(self.weight_dtype)
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, qweight.to(x.dtype) * self.scale.to(x.dtype), bias)
+
+def quantize_linears(module, dtype):
+    # replace all the nn.Linear layers of the module with QuantizedLinear
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, QuantizedLinear(child.weight.data, child.bias.data if child.bias is not None else None, dtype=dtype))
+        else:
+            quantize_linears(child, dtype)
+    return module
+
 class To_KV(nn.Module):
-    def __init__(self, state_dict):
+    def __init__(self, state_dict, weight_dtype=None):
         super().__init__()
 
         self.to_kvs = nn.ModuleDict()
         for key, value in state_dict.items():
-            self.to_kvs[key.replace(".weight", "").replace(".", "_")] = nn.Linear(value.shape[1], value.shape[0], bias=False)
-            self.to_kvs[key.replace(".weight", "").replace(".", "_")].weight.data = value
+            if key.endswith("to_v_ip.weight"):
+                continue # merged into the matching to_k_ip layer
+            if key.endswith("to_k_ip.weight"):
+                # stack the k and v projections so that both are computed with a single matmul
+                value = torch.cat((value, state_dict[key.replace("to_k_ip", "to_v_ip")]), dim=0)
+                key = key.replace("to_k_ip", "to_kv_ip")
+            if weight_dtype is not None:
+                self.to_kvs[key.replace(".weight", "").replace(".", "_")] = QuantizedLinear(value, dtype=weight_dtype)
+            else:
+                self.to_kvs[key.replace(".weight", "").replace(".", "_")] = nn.Linear(value.shape[1], value.shape[0], bias=False)
+                self.to_kvs[key.replace(".weight", "").replace(".", "_")].weight.data = value
+
+        # weights these layers were built from, the id of a freed state dict can be reused
+        self.source = weakref.ref(next(iter(state_dict.values())))
+
+        # the float weights are views of one flat buffer (pinned if there's a GPU), moving them is a single copy
+        self.weights = None
+        if weight_dtype is None:
+            layers = list(self.to_kvs.values())
+            dtype = layers[0].weight.dtype
+            for layer in layers[1:]:
+                dtype = torch.promote_types(dtype, layer.weight.dtype)
+            self.weights = torch.empty(sum(layer.weight.numel() for layer in layers), dtype=dtype, pin_memory=torch.cuda.is_available())
+            offset = 0
+            for layer in layers:
+                self.weights[offset:offset+layer.weight.numel()].copy_(layer.weight.data.flatten())
+                offset += layer.weight.numel()
+            self.set_weight_views()
+
+    def set_weight_views(self):
+        offset = 0
+        for layer in self.to_kvs.values():
+            numel = layer.weight.numel()
+            layer.weight.data = self.weights[offset:offset+numel].view(layer.weight.shape)
+            offset += numel
+
+    def to(self, *args, **kwargs):
+        if self.weights is None:
+            return super().to(*args, **kwargs)
+
+        device, dtype, _, _ = torch._C._nn._parse_to(*args, **kwargs)
+        device = self.weights.device if device is None else device
+        dtype = self.weights.dtype if dtype is None else dtype
+        if device.type == "cpu" and self.weights.device.type != "cpu" and torch.cuda.is_available():
+            # back to pinned memory for the next move to the device
+            weights = torch.empty(self.weights.shape, dtype=dtype, pin_memory=True)
+            self.weights = weights.copy_(self.weights)
+        else:
+            self.weights = self.weights.to(device, dtype=dtype, non_blocking=self.weights.is_pinned())
+        self.set_weight_views()
+        return self
 
-def set_model_patch_replace(model, patch_kwargs, key):
+# ip layers of each ip_adapter state dict, alive as long as a patched model uses them
+to_kv_cache = weakref.WeakValueDictionary()
+
+def get_to_kv(state_dict, weight_dtype=None):
+    key = (id(state_dict), weight_dtype)
+    ip_layers = to_kv_cache.get(key)
+    if ip_layers is None or ip_layers.source() is not next(iter(state_dict.values())):
+        ip_layers = To_KV(state_dict, weight_dtype)
+        to_kv_cache[key] = ip_layers
+    return ip_layers
+
+# attn2 patch keys in the order of the ip layers
+SD15_ATTN2_KEYS = [("input", id) for id in [1,2,4,5,7,8]] # id of input_blocks that have cross attention
+SD15_ATTN2_KEYS += [("output", id) for id in [3,4,5,6,7,8,9,10,11]] # id of output_blocks that have cross attention
+SD15_ATTN2_KEYS += [("middle", 0)]
+# (block id, transformer index), transformer_depth is 2 or 10 depending on the block
+SDXL_ATTN2_KEYS = [("input", id, index) for id in [4,5,7,8] for index in range(2 if id in [4, 5] else 10)]
+SDXL_ATTN2_KEYS += [("output", id, index) for id in range(6) for index in range(2 if id in [3, 4, 5] else 10)]
+SDXL_ATTN2_KEYS += [("middle", 0, index) for index in range(10)]
+
+def set_model_patch_replace(model, patch_kwargs, keys):
     to = model.model_options["transformer_options"]
-    if "patches_replace" not in to:
-        to["patches_replace"] = {}
-    if "attn2" not in to["patches_replace"]:
-        to["patches_replace"]["attn2"] = {}
-    if key not in to["patches_replace"]["attn2"]:
-        patch = CrossAttentionPatch(**patch_kwargs)
-        to["patches_replace"]["attn2"][key] = patch
-    else:
-        to["patches_replace"]["attn2"][key].set_new_condition(**patch_kwargs)
+    patches = to.setdefault("patches_replace", {}).setdefault("attn2", {})
+    for number, key in enumerate(keys):
+        kwargs = {**patch_kwargs, "number": number}
+        if key not in patches:
+            patches[key] = CrossAttentionPatch(**kwargs)
+        else:
+            patches[key].set_new_condition(**kwargs)
 
 def image_add_noise(image, noise):
     image = image.permute([0,3,1,2])
@@ -177,35 +302,176 @@ def image_add_noise(image, noise):
         TT.RandomVerticalFlip(p=1.0), # flip the image to change the geometry even more
         TT.RandomHorizontalFlip(p=1.0),
     ])
-    image = transforms(image.cpu())
+    image = transforms(image) # torchvision transforms run on the image's device
     image = image.permute([0,2,3,1])
-    image = image + ((0.25*(1-noise)+0.05) * torch.randn_like(image) )   # add further random noise
+    # add further random noise. It's drawn by the CPU generator whatever the image's device, the CUDA
+    # generator gives a different sequence for the same seed and the negative would depend on the device
+    image = image + ((0.25*(1-noise)+0.05) * torch.randn(image.shape, dtype=image.dtype).to(image.device) )
     return image
 
+def crop_and_resize(image, width, height, mode="bilinear"):
+    # same center crop as comfy.utils.common_upscale(..., "center") but on IMAGE (NHWC) tensors,
+    # the resize is antialiased like PIL's
+    _, oh, ow, _ = image.shape
+    old_aspect = ow / oh
+    new_aspect = width / height
+    x = 0
+    y = 0
+    if old_aspect > new_aspect:
+        x = round((ow - ow * (new_aspect / old_aspect)) / 2)
+    elif old_aspect < new_aspect:
+        y = round((oh - oh * (old_aspect / new_aspect)) / 2)
+    image = image[:, y:oh-y, x:ow-x]
+
+    # a permuted NHWC tensor is a channels_last NCHW tensor, interpolate works on it directly
+    # and keeps the layout. Permuting back is then a contiguous view, no copy in either direction
+    image = image.permute(0, 3, 1, 2)
+    image = F.interpolate(image, size=(height, width), mode=mode, antialias=mode in ["bilinear", "bicubic"])
+    return image.contiguous(memory_format=torch.channels_last).permute(0, 2, 3, 1)
+
+zeroed_hidden_states_cache = weakref.WeakKeyDictionary()
+
 def zeroed_hidden_states(clip_vision, batch_size):
-    image = torch.zeros([batch_size, 224, 224, 3])
-    comfy.model_management.load_model_gpu(clip_vision.patcher)
-    pixel_values = clip_preprocess(image.to(clip_vision.load_device)).float()
-    outputs = clip_vision.model(pixel_values=pixel_values, intermediate_output=-2)
-    # we only need the penultimate hidden states
-    outputs = outputs[1].to(comfy.model_management.intermediate_device())
-    return outputs
+    # the hidden states of a black image only depend on the clip vision model,
+    # they are computed once for a single image and expanded to the batch
+    outputs = zeroed_hidden_states_cache.get(clip_vision)
+    if outputs is None:
+        image = torch.zeros([1, 224, 224, 3])
+        comfy.model_management.load_model_gpu(clip_vision.patcher)
+        pixel_values = clip_preprocess(image.to(clip_vision.load_device)).float()
+        outputs = clip_vision.model(pixel_values=pixel_values, intermediate_output=-2)
+        # we only need the penultimate hidden states
+        outputs = outputs[1].to(comfy.model_management.intermediate_device())
+        zeroed_hidden_states_cache[clip_vision] = outputs
+    return outputs.expand(batch_size, *outputs.shape[1:])
+
+def zeros_like_expanded(tensor):
+    # a single zero expanded to the shape of the tensor, nothing is allocated or filled
+    return tensor.new_zeros(()).expand_as(tensor)
+
+def encode_image_embeds(clip_vision, image, noise, is_plus):
+    # returns the cond and uncond embeds of the image. When the noised negative image
+    # has the same size as the reference they are encoded in a single forward pass
+    n = image.shape[0]
+    neg_image = image_add_noise(image, noise) if noise > 0 else None
+
+    if neg_image is not None and neg_image.shape[1:] == image.shape[1:]:
+        clip_embed = clip_vision.encode_image(torch.cat((image, neg_image), dim=0))
+        clip_embed = clip_embed.penultimate_hidden_states if is_plus else clip_embed.image_embeds
+        return clip_embed[:n], clip_embed[n:]
+
+    clip_embed = clip_vision.encode_image(image)
+    clip_embed = clip_embed.penultimate_hidden_states if is_plus else clip_embed.image_embeds
+    if neg_image is not None:
+        clip_embed_zeroed = clip_vision.encode_image(neg_image)
+        clip_embed_zeroed = clip_embed_zeroed.penultimate_hidden_states if is_plus else clip_embed_zeroed.image_embeds
+    elif is_plus:
+        clip_embed_zeroed = zeroed_hidden_states(clip_vision, n)
+    else:
+        clip_embed_zeroed = zeros_like_expanded(clip_embed)
+
+    return clip_embed, clip_embed_zeroed
+
+def unpack_embeds(embeds):
+    # EMBEDS are a (cond, uncond) tuple, previous versions stacked the two in a single tensor
+    return embeds[0], embeds[1]
+
+def cat_embeds(tensors):
+    # concatenate on the batch dimension. Embeds that were split from the same tensor and are still
+    # contiguous and adjacent in its storage are joined back with a view instead of a copy
+    first = tensors[0]
+    storage = first.untyped_storage().data_ptr()
+    ptr = first.data_ptr()
+    for t in tensors:
+        if t.dtype != first.dtype or t.shape[1:] != first.shape[1:] or not t.is_contiguous() or t.untyped_storage().data_ptr() != storage or t.data_ptr() != ptr:
+            return torch.cat(tensors, dim=0)
+        ptr += t.numel() * t.element_size()
+
+    size = (sum(t.shape[0] for t in tensors), *first.shape[1:])
+    stride = [1]
+    for dim in reversed(size[1:]):
+        stride.insert(0, stride[0] * dim)
+    return torch.as_strided(first, size, stride)
 
 def min_(tensor_list):
     # return the element-wise min of the tensor list.
-    x = torch.stack(tensor_list)
-    mn = x.min(axis=0)[0]
-    return torch.clamp(mn, min=0)
+    # only one output tensor is allocated, the following reductions are in place
+    mn = torch.minimum(tensor_list[0], tensor_list[1])
+    for t in tensor_list[2:]:
+        torch.minimum(mn, t, out=mn)
+    return mn.clamp_(min=0)
     
 def max_(tensor_list):
     # return the element-wise max of the tensor list.
-    x = torch.stack(tensor_list)
-    mx = x.max(axis=0)[0]
-    return torch.clamp(mx, max=1)
+    mx = torch.maximum(tensor_list[0], tensor_list[1])
+    for t in tensor_list[2:]:
+        torch.maximum(mx, t, out=mx)
+    return mx.clamp_(max=1)
+
+if triton is not None:
+    @triton.jit
+    def cas_kernel(X_ptr, Y_ptr, H, W, amount, BLOCK_H: tl.constexpr, BLOCK_W: tl.constexpr):
+        # one program sharpens a BLOCK_H x BLOCK_W tile of one channel, reading the 3x3 neighborhood only once
+        pid_h = tl.program_id(0)
+        pid_w = tl.program_id(1)
+        pid_c = tl.program_id(2)
+        rows = (pid_h * BLOCK_H + tl.arange(0, BLOCK_H))[:, None]
+        cols = (pid_w * BLOCK_W + tl.arange(0, BLOCK_W))[None, :]
+        X_ptr += pid_c * H * W
+        Y_ptr += pid_c * H * W
+
+        # out of bounds neighbors are 0 like the zero padding of the torch version
+        r0 = rows - 1
+        r2 = rows + 1
+        c0 = cols - 1
+        c2 = cols + 1
+        mr0 = (r0 >= 0) & (r0 < H)
+        mr1 = rows < H
+        mr2 = r2 < H
+        mc0 = (c0 >= 0) & (c0 < W)
+        mc1 = cols < W
+        mc2 = c2 < W
+        a = tl.load(X_ptr + r0 * W + c0, mask=mr0 & mc0, other=0.0)
+        b = tl.load(X_ptr + r0 * W + cols, mask=mr0 & mc1, other=0.0)
+        c = tl.load(X_ptr + r0 * W + c2, mask=mr0 & mc2, other=0.0)
+        d = tl.load(X_ptr + rows * W + c0, mask=mr1 & mc0, other=0.0)
+        e = tl.load(X_ptr + rows * W + cols, mask=mr1 & mc1, other=0.0)
+        f = tl.load(X_ptr + rows * W + c2, mask=mr1 & mc2, other=0.0)
+        g = tl.load(X_ptr + r2 * W + c0, mask=mr2 & mc0, other=0.0)
+        h = tl.load(X_ptr + r2 * W + cols, mask=mr2 & mc1, other=0.0)
+        i = tl.load(X_ptr + r2 * W + c2, mask=mr2 & mc2, other=0.0)
+
+        # Computing contrast
+        mn = tl.maximum(tl.minimum(tl.minimum(tl.minimum(b, d), tl.minimum(e, f)), h), 0.0)
+        mx = tl.minimum(tl.maximum(tl.maximum(tl.maximum(b, d), tl.maximum(e, f)), h), 1.0)
+        mn2 = tl.maximum(tl.minimum(tl.minimum(a, c), tl.minimum(g, i)), 0.0)
+        mx2 = tl.minimum(tl.maximum(tl.maximum(a, c), tl.maximum(g, i)), 1.0)
+        mx = mx + mx2
+        mn = mn + mn2
+
+        # Computing local weight
+        amp = tl.sqrt((1.0 / mx) * tl.minimum(mn, 2.0 - mx))
+        w = -amp * (amount * (1/5 - 1/8) + 1/8)
+
+        output = ((b + d + f + h) * w + e) / (1.0 + 4.0 * w)
+        output = tl.minimum(tl.maximum(output, 0.0), 1.0)
+        output = tl.where(output != output, 0.0, output) # nan_to_num
+        tl.store(Y_ptr + rows * W + cols, output, mask=mr1 & mc1)
+
+def contrast_adaptive_sharpening_triton(image, amount, BLOCK_H=16, BLOCK_W=64):
+    x = image.float().contiguous()
+    y = torch.empty_like(x)
+    H, W = x.shape[-2:]
+    grid = (triton.cdiv(H, BLOCK_H), triton.cdiv(W, BLOCK_W), x.numel() // (H * W))
+    cas_kernel[grid](x, y, H, W, amount, BLOCK_H=BLOCK_H, BLOCK_W=BLOCK_W)
+    return y
 
 # From https://github.com/Jamy-L/Pytorch-Contrast-Adaptive-Sharpening/
 def contrast_adaptive_sharpening(image, amount):
-    img = F.pad(image, pad=(1, 1, 1, 1)).cpu()
+    if triton is not None and image.is_cuda:
+        return contrast_adaptive_sharpening_triton(image, amount)
+
+    img = F.pad(image, pad=(1, 1, 1, 1))
 
     a = img[..., :-2, :-2]
     b = img[..., :-2, 1:-1]
@@ -217,35 +483,37 @@ def contrast_adaptive_sharpening(image, amount):
     h = img[..., 2:, 1:-1]
     i = img[..., 2:, 2:]
     
+    # the intermediate results are computed in place, the sharpening is memory bound
+    # and each temporary would be another full pass over the image
+
     # Computing contrast
     cross = (b, d, e, f, h)
     mn = min_(cross)
     mx = max_(cross)
     
     diag = (a, c, g, i)
-    mn2 = min_(diag)
-    mx2 = max_(diag)
-    mx = mx + mx2
-    mn = mn + mn2
+    mn.add_(min_(diag))
+    mx.add_(max_(diag))
     
     # Computing local weight
-    inv_mx = torch.reciprocal(mx)
-    amp = inv_mx * torch.minimum(mn, (2 - mx))
+    amp = torch.minimum(mn, torch.rsub(mx, 2), out=mn)
+    amp.mul_(mx.reciprocal_())
 
     # scaling
-    amp = torch.sqrt(amp)
-    w = - amp * (amount * (1/5 - 1/8) + 1/8)
-    div = torch.reciprocal(1 + 4*w)
+    w = amp.sqrt_().mul_(-(amount * (1/5 - 1/8) + 1/8))
+    div = torch.mul(w, 4, out=mx).add_(1).reciprocal_()
 
-    output = ((b + d + f + h)*w + e) * div
-    output = output.clamp(0, 1)
-    output = torch.nan_to_num(output)
+    output = b + d
+    output.add_(f).add_(h).mul_(w).add_(e).mul_(div)
+    output.clamp_(0, 1)
+    output.nan_to_num_()
 
     return (output)
 
 def tensorToNP(image):
-    out = torch.clamp(255. * image.detach().cpu(), 0, 255).to(torch.uint8)
-    out = out[..., [2, 1, 0]]
+    # convert to uint8 before leaving the device, it's a quarter of the data to copy
+    out = torch.clamp(255. * image.detach(), 0, 255).to(torch.uint8)
+    out = out[..., [2, 1, 0]].cpu()
     out = out.numpy()
 
     return out
@@ -269,6 +537,21 @@ class IPAdapterImageEmbedder():
         self.is_full = is_full
         self.is_plus = is_plus
 
+        self.device = device
+        self.dtype = dtype
+
+        use_compile = TORCH_COMPILE and not QUANTIZE_WEIGHTS
+        compile_key = (is_faceid, is_plus, is_full, is_sdxl, cross_attention_dim, output_cross_attention_dim, clip_embeddings_dim, clip_extra_context_tokens, device, dtype)
+        if use_compile and compile_key in compiled_proj_models:
+            # same architecture, reuse the compiled model with the new weights
+            image_proj_model, self.image_proj_model = compiled_proj_models[compile_key]
+            image_proj_model.load_state_dict(ipadapter_model["image_proj"])
+            image_proj_model.to(device)
+            self.compiled = True
+            return
+
+        self.compiled = use_compile
+
         if is_faceid:
             self.image_proj_model = self.init_proj_faceid()
         elif is_plus:
@@ -277,9 +560,19 @@ class IPAdapterImageEmbedder():
             self.image_proj_model = self.init_proj()
 
         self.image_proj_model.load_state_dict(ipadapter_model["image_proj"])
+        if QUANTIZE_WEIGHTS and hasattr(torch, "float8_e4m3fn"):
+            # the projection only runs once per apply, halve the weights to move to the device
+            quantize_linears(self.image_proj_model, torch.float8_e4m3fn)
         self.image_proj_model.to(device, dtype=dtype)
-        self.device = device
-        self.dtype = dtype
+
+        if use_compile:
+            compiled_proj_models[compile_key] = (self.image_proj_model, torch.compile(self.image_proj_model, dynamic=True))
+            self.image_proj_model = compiled_proj_models[compile_key][1]
+
+    def offload(self):
+        # the compiled models outlive the embedder, their weights are moved out of the VRAM until the next apply
+        if self.compiled:
+            self.image_proj_model.to(comfy.model_management.unet_offload_device())
 
     def init_proj(self):
         image_proj_model = ImageProjModel(
@@ -326,17 +619,26 @@ class IPAdapterImageEmbedder():
 
     @torch.inference_mode()
     def get_image_embeds(self, clip_embed, clip_embed_zeroed):
-        image_prompt_embeds = self.image_proj_model(clip_embed.to(self.device, dtype=self.dtype))
-        uncond_image_prompt_embeds = self.image_proj_model(clip_embed_zeroed.to(self.device, dtype=self.dtype))
+        # cond and uncond in a single forward pass. They are moved to the device before the concatenation
+        # so that the copy of pinned embeds (see IPAdapterLoadEmbeds) is asynchronous
+        clip_embed = clip_embed.to(self.device, dtype=self.dtype, non_blocking=True)
+        clip_embed_zeroed = clip_embed_zeroed.to(self.device, dtype=self.dtype, non_blocking=True)
+        embeds = self.image_proj_model(torch.cat((clip_embed, clip_embed_zeroed), dim=0))
+        image_prompt_embeds, uncond_image_prompt_embeds = embeds.chunk(2, dim=0)
         return image_prompt_embeds, uncond_image_prompt_embeds
 
     @torch.inference_mode()
-    def get_image_embeds_faceid_plus(self, face_embed, clip_embed, s_scale, shortcut):
-        embeds = self.image_proj_model(face_embed.to(self.device, dtype=self.dtype), clip_embed.to(self.device, dtype=self.dtype), scale=s_scale, shortcut=shortcut)
-        return embeds
+    def get_image_embeds_faceid_plus(self, face_embed, clip_embed, face_embed_zeroed, clip_embed_zeroed, s_scale, shortcut):
+        face_embed = torch.cat((face_embed, face_embed_zeroed), dim=0).to(self.device, dtype=self.dtype)
+        clip_embed = torch.cat((clip_embed, clip_embed_zeroed), dim=0).to(self.device, dtype=self.dtype)
+        embeds = self.image_proj_model(face_embed, clip_embed, scale=s_scale, shortcut=shortcut)
+        image_prompt_embeds, uncond_image_prompt_embeds = embeds.chunk(2, dim=0)
+        return image_prompt_embeds, uncond_image_prompt_embeds
 
 class CrossAttentionPatch:
     # forward for patching
+    sigma_cache = (None, None) # (sigmas tensor of the current step, sigma value)
+
     def __init__(self, weight, ip_layers, number, cond, uncond, weight_type, mask=None, sigma_start=0.0, sigma_end=1.0, unfold_batch=False):
         self.weights = [weight]
         self.ip_layers = [ip_layers]
@@ -348,9 +650,12 @@ class CrossAttentionPatch:
         self.sigma_start = [sigma_start]
         self.sigma_end = [sigma_end]
         self.unfold_batch = [unfold_batch]
+        self.kv_cache = [None] # ip k/v projections, they only change with the AnimateDiff context window
+        self.mask_cache = [None] # downsampled attention masks
+        self.cond_or_uncond_idx = {}
+        self.active = None # (sigma, any adapter active at sigma)
 
-        self.k_key = str(self.number*2+1) + "_to_k_ip"
-        self.v_key = str(self.number*2+1) + "_to_v_ip"
+        self.kv_key = str(self.number*2+1) + "_to_kv_ip"
         self.current_device = cond.device
     
     def set_new_condition(self, weight, ip_layers, number, cond, uncond, weight_type, mask=None, sigma_start=0.0, sigma_end=1.0, unfold_batch=False):
@@ -363,12 +668,17 @@ class CrossAttentionPatch:
         self.sigma_start.append(sigma_start)
         self.sigma_end.append(sigma_end)
         self.unfold_batch.append(unfold_batch)
+        self.kv_cache.append(None)
+        self.mask_cache.append(None)
+        self.active = None
 
     def to(self, device_or_dtype):
         ''' move to device or convert to dtype '''
         if not isinstance(device_or_dtype, torch.device): # ignore dtype conversions
             return self
         dtype = torch.float16 if comfy.model_management.should_use_fp16() else torch.float32
+        self.kv_cache = [None] * len(self.conds)
+        self.mask_cache = [None] * len(self.conds)
         for i in range(len(self.conds)):
             self.conds[i] = self.conds[i].to(device_or_dtype, dtype=dtype)
             self.unconds[i] = self.unconds[i].to(device_or_dtype, dtype=dtype)
@@ -380,7 +690,18 @@ class CrossAttentionPatch:
     def __call__(self, n, context_attn2, value_attn2, extra_options):
         org_dtype = n.dtype
         cond_or_uncond = extra_options["cond_or_uncond"]
-        sigma = extra_options["sigmas"][0].item() if 'sigmas' in extra_options else 999999999.9
+        sigma = 999999999.9
+        if 'sigmas' in extra_options:
+            # .item() waits for the device, it's done once per step for all the patches
+            if CrossAttentionPatch.sigma_cache[0] is not extra_options["sigmas"]:
+                CrossAttentionPatch.sigma_cache = (extra_options["sigmas"], extra_options["sigmas"][0].item())
+            sigma = CrossAttentionPatch.sigma_cache[1]
+
+        # plain attention if none of the adapters is active at this sigma, the answer is cached for the step
+        if self.active is None or self.active[0] != sigma:
+            self.active = (sigma, any(sigma_start >= sigma >= sigma_end for sigma_start, sigma_end in zip(self.sigma_start, self.sigma_end)))
+        if not self.active[1]:
+            return optimized_attention(n, context_attn2, value_attn2, extra_options["n_heads"]).to(dtype=org_dtype)
 
         # extra options for AnimateDiff
         ad_params = extra_options['ad_params'] if "ad_params" in extra_options else None
@@ -393,113 +714,150 @@ class CrossAttentionPatch:
         batch_prompt = b // len(cond_or_uncond)
         out = optimized_attention(q, k, v, extra_options["n_heads"])
         _, _, lh, lw = extra_options["original_shape"]
-        
-        for weight, cond, uncond, ip_layers, mask, weight_type, sigma_start, sigma_end, unfold_batch in zip(self.weights, self.conds, self.unconds, self.ip_layers, self.masks, self.weight_type, self.sigma_start, self.sigma_end, self.unfold_batch):
+
+        # gather index of the cond/uncond k/v for each chunk of the batch, kept to avoid a copy to the device at every call
+        idx_key = (tuple(cond_or_uncond), q.device)
+        if idx_key not in self.cond_or_uncond_idx:
+            self.cond_or_uncond_idx[idx_key] = torch.tensor(cond_or_uncond, dtype=torch.long, device=q.device)
+        cond_or_uncond_idx = self.cond_or_uncond_idx[idx_key]
+
+        ip_attn = []
+        for i, (weight, cond, uncond, ip_layers, mask, weight_type, sigma_start, sigma_end, unfold_batch) in enumerate(zip(self.weights, self.conds, self.unconds, self.ip_layers, self.masks, self.weight_type, self.sigma_start, self.sigma_end, self.unfold_batch)):
             if sigma > sigma_start or sigma < sigma_end:
                 continue
-            if unfold_batch and cond.shape[0] > 1:
-                # Check AnimateDiff context window
-                if ad_params is not None and ad_params["sub_idxs"] is not None:
-                    # if images length matches or exceeds full_length get sub_idx images
-                    if cond.shape[0] >= ad_params["full_length"]:
-                        cond = torch.Tensor(cond[ad_params["sub_idxs"]])
-                        uncond = torch.Tensor(uncond[ad_params["sub_idxs"]])
-                    # otherwise, need to do more to get proper sub_idxs masks
-                    else:
-                        # check if images length matches full_length - if not, make it match
-                        if cond.shape[0] < ad_params["full_length"]:
-                            cond = torch.cat((cond, cond[-1:].repeat((ad_params["full_length"]-cond.shape[0], 1, 1))), dim=0)
-                            uncond = torch.cat((uncond, uncond[-1:].repeat((ad_params["full_length"]-uncond.shape[0], 1, 1))), dim=0)
-                        # if we have too many remove the excess (should not happen, but just in case)
-                        if cond.shape[0] > ad_params["full_length"]:
-                            cond = cond[:ad_params["full_length"]]
-                            uncond = uncond[:ad_params["full_length"]]
-                        cond = cond[ad_params["sub_idxs"]]
-                        uncond = uncond[ad_params["sub_idxs"]]
-
-                # if we don't have enough reference images repeat the last one until we reach the right size
-                if cond.shape[0] < batch_prompt:
-                    cond = torch.cat((cond, cond[-1:].repeat((batch_prompt-cond.shape[0], 1, 1))), dim=0)
-                    uncond = torch.cat((uncond, uncond[-1:].repeat((batch_prompt-uncond.shape[0], 1, 1))), dim=0)
-                # if we have too many remove the exceeding
-                elif cond.shape[0] > batch_prompt:
-                    cond = cond[:batch_prompt]
-                    uncond = uncond[:batch_prompt]
-
-                k_cond = ip_layers.to_kvs[self.k_key](cond)
-                k_uncond = ip_layers.to_kvs[self.k_key](uncond)
-                v_cond = ip_layers.to_kvs[self.v_key](cond)
-                v_uncond = ip_layers.to_kvs[self.v_key](uncond)
+            unfold = unfold_batch and cond.shape[0] > 1
+
+            # cond and uncond don't change during sampling, the ip k/v are computed only once unless the unfolded batch changes
+            cache_key = None
+            if unfold:
+                cache_key = (batch_prompt, ) if ad_params is None or ad_params["sub_idxs"] is None else (batch_prompt, ad_params["full_length"], tuple(ad_params["sub_idxs"]))
+            if self.kv_cache[i] is None or self.kv_cache[i][0] != cache_key:
+                if unfold:
+                    # Check AnimateDiff context window
+                    if ad_params is not None and ad_params["sub_idxs"] is not None:
+                        # if images length matches or exceeds full_length get sub_idx images
+                        if cond.shape[0] >= ad_params["full_length"]:
+                            cond = torch.Tensor(cond[ad_params["sub_idxs"]])
+                            uncond = torch.Tensor(uncond[ad_params["sub_idxs"]])
+                        # otherwise, need to do more to get proper sub_idxs masks
+                        else:
+                            # check if images length matches full_length - if not, make it match
+                            if cond.shape[0] < ad_params["full_length"]:
+                                cond = torch.cat((cond, cond[-1:].repeat((ad_params["full_length"]-cond.shape[0], 1, 1))), dim=0)
+                                uncond = torch.cat((uncond, uncond[-1:].repeat((ad_params["full_length"]-uncond.shape[0], 1, 1))), dim=0)
+                            # if we have too many remove the excess (should not happen, but just in case)
+                            if cond.shape[0] > ad_params["full_length"]:
+                                cond = cond[:ad_params["full_length"]]
+                                uncond = uncond[:ad_params["full_length"]]
+                            cond = cond[ad_params["sub_idxs"]]
+                            uncond = uncond[ad_params["sub_idxs"]]
+
+                    # if we don't have enough reference images repeat the last one until we reach the right size
+                    if cond.shape[0] < batch_prompt:
+                        cond = torch.cat((cond, cond[-1:].repeat((batch_prompt-cond.shape[0], 1, 1))), dim=0)
+                        uncond = torch.cat((uncond, uncond[-1:].repeat((batch_prompt-uncond.shape[0], 1, 1))), dim=0)
+                    # if we have too many remove the exceeding
+                    elif cond.shape[0] > batch_prompt:
+                        cond = cond[:batch_prompt]
+                        uncond = uncond[:batch_prompt]
+
+                # k and v of both cond and uncond with a single matmul
+                self.kv_cache[i] = (cache_key, ip_layers.to_kvs[self.kv_key](torch.cat((cond, uncond), dim=0)))
+
+            # (cond/uncond, batch_prompt, images, tokens, dim), without unfold_batch all the images
+            # are expanded (not copied) to each prompt, the gather below is the only copy
+            kv = self.kv_cache[i][1]
+            if unfold:
+                kv = kv.view(2, -1, 1, *kv.shape[1:])
             else:
-                k_cond = ip_layers.to_kvs[self.k_key](cond).repeat(batch_prompt, 1, 1)
-                k_uncond = ip_layers.to_kvs[self.k_key](uncond).repeat(batch_prompt, 1, 1)
-                v_cond = ip_layers.to_kvs[self.v_key](cond).repeat(batch_prompt, 1, 1)
-                v_uncond = ip_layers.to_kvs[self.v_key](uncond).repeat(batch_prompt, 1, 1)
+                kv = kv.view(2, 1, -1, *kv.shape[1:]).expand(-1, batch_prompt, -1, -1, -1)
+            kv_k, kv_v = kv.chunk(2, dim=-1)
+            ip_k = kv_k.index_select(0, cond_or_uncond_idx).flatten(0, 2)
+            ip_v = kv_v.index_select(0, cond_or_uncond_idx).flatten(0, 2)
 
             if weight_type.startswith("linear"):
-                ip_k = torch.cat([(k_cond, k_uncond)[i] for i in cond_or_uncond], dim=0) * weight
-                ip_v = torch.cat([(v_cond, v_uncond)[i] for i in cond_or_uncond], dim=0) * weight
+                ip_k = ip_k * weight
+                ip_v = ip_v * weight
+            elif weight_type.startswith("channel"):
+                # code by Lvmin Zhang at Stanford University as also seen on Fooocus IPAdapter implementation
+                # please read licensing notes https://github.com/lllyasviel/Fooocus/blob/69a23c4d60c9e627409d0cb0f8862cdb015488eb/extras/ip_adapter.py#L234
+                ip_v_mean = torch.mean(ip_v, dim=1, keepdim=True)
+                _, _, C = ip_k.shape
+                channel_penalty = float(C) / 1280.0
+                W = weight * channel_penalty
+                ip_k = ip_k * W
+                # (ip_v - mean) + mean * W, in place since ip_v is a fresh gather
+                ip_v.sub_(ip_v_mean * (1 - W))
+
+            ip_attn.append((i, ip_k, ip_v, weight, weight_type, mask))
+
+        # adapters with the same number of image tokens are batched into a single attention call
+        groups = {}
+        for entry in ip_attn:
+            groups.setdefault(entry[1].shape, []).append(entry)
+
+        for group in groups.values():
+            if len(group) > 1:
+                ip_k = torch.cat([entry[1] for entry in group], dim=0)
+                ip_v = torch.cat([entry[2] for entry in group], dim=0)
+                out_ips = optimized_attention(q.repeat(len(group), 1, 1), ip_k, ip_v, extra_options["n_heads"]).chunk(len(group), dim=0)
             else:
-                ip_k = torch.cat([(k_cond, k_uncond)[i] for i in cond_or_uncond], dim=0)
-                ip_v = torch.cat([(v_cond, v_uncond)[i] for i in cond_or_uncond], dim=0)
-
-                if weight_type.startswith("channel"):
-                    # code by Lvmin Zhang at Stanford University as also seen on Fooocus IPAdapter implementation
-                    # please read licensing notes https://github.com/lllyasviel/Fooocus/blob/69a23c4d60c9e627409d0cb0f8862cdb015488eb/extras/ip_adapter.py#L234
-                    ip_v_mean = torch.mean(ip_v, dim=1, keepdim=True)
-                    ip_v_offset = ip_v - ip_v_mean
-                    _, _, C = ip_k.shape
-                    channel_penalty = float(C) / 1280.0
-                    W = weight * channel_penalty
-                    ip_k = ip_k * W
-                    ip_v = ip_v_offset + ip_v_mean * W
-
-            out_ip = optimized_attention(q, ip_k, ip_v, extra_options["n_heads"])           
-            if weight_type.startswith("original"):
-                out_ip = out_ip * weight
-
-            if mask is not None:
-                # TODO: needs checking
-                mask_h = lh / math.sqrt(lh * lw / qs)
-                mask_h = int(mask_h) + int((qs % int(mask_h)) != 0)
-                mask_w = qs // mask_h
-
-                # check if using AnimateDiff and sliding context window
-                if (mask.shape[0] > 1 and ad_params is not None and ad_params["sub_idxs"] is not None):
-                    # if mask length matches or exceeds full_length, just get sub_idx masks, resize, and continue
-                    if mask.shape[0] >= ad_params["full_length"]:
-                        mask_downsample = torch.Tensor(mask[ad_params["sub_idxs"]])
-                        mask_downsample = F.interpolate(mask_downsample.unsqueeze(1), size=(mask_h, mask_w), mode="bicubic").squeeze(1)
-                    # otherwise, need to do more to get proper sub_idxs masks
-                    else:
-                        # resize to needed attention size (to save on memory)
-                        mask_downsample = F.interpolate(mask.unsqueeze(1), size=(mask_h, mask_w), mode="bicubic").squeeze(1)
-                        # check if mask length matches full_length - if not, make it match
-                        if mask_downsample.shape[0] < ad_params["full_length"]:
-                            mask_downsample = torch.cat((mask_downsample, mask_downsample[-1:].repeat((ad_params["full_length"]-mask_downsample.shape[0], 1, 1))), dim=0)
-                        # if we have too many remove the excess (should not happen, but just in case)
-                        if mask_downsample.shape[0] > ad_params["full_length"]:
-                            mask_downsample = mask_downsample[:ad_params["full_length"]]
-                        # now, select sub_idxs masks
-                        mask_downsample = mask_downsample[ad_params["sub_idxs"]]
-                # otherwise, perform usual mask interpolation
-                else:
-                    mask_downsample = F.interpolate(mask.unsqueeze(1), size=(mask_h, mask_w), mode="bicubic").squeeze(1)
-
-                # if we don't have enough masks repeat the last one until we reach the right size
-                if mask_downsample.shape[0] < batch_prompt:
-                    mask_downsample = torch.cat((mask_downsample, mask_downsample[-1:, :, :].repeat((batch_prompt-mask_downsample.shape[0], 1, 1))), dim=0)
-                # if we have too many remove the exceeding
-                elif mask_downsample.shape[0] > batch_prompt:
-                    mask_downsample = mask_downsample[:batch_prompt, :, :]
+                out_ips = [optimized_attention(q, group[0][1], group[0][2], extra_options["n_heads"])]
+
+            for out_ip, (i, _, _, weight, weight_type, mask) in zip(out_ips, group):
+                if weight_type.startswith("original"):
+                    out_ip = out_ip * weight
+
+                if mask is not None:
+                    # the downsampled mask only depends on the shape of the batch, it's computed once for the whole sampling
+                    mask_key = (qs, lh, lw, len(cond_or_uncond), batch_prompt)
+                    if mask.shape[0] > 1 and ad_params is not None and ad_params["sub_idxs"] is not None:
+                        mask_key += (ad_params["full_length"], tuple(ad_params["sub_idxs"]))
+                    if self.mask_cache[i] is None or self.mask_cache[i][0] != mask_key:
+                        # TODO: needs checking
+                        mask_h = lh / math.sqrt(lh * lw / qs)
+                        mask_h = int(mask_h) + int((qs % int(mask_h)) != 0)
+                        mask_w = qs // mask_h
+                        # masks are only used as a multiplier, area is enough to downsample them
+                        mode = "area" if mask_h * mask_w < mask.shape[-2] * mask.shape[-1] else "bilinear"
+
+                        # check if using AnimateDiff and sliding context window
+                        if (mask.shape[0] > 1 and ad_params is not None and ad_params["sub_idxs"] is not None):
+                            # if mask length matches or exceeds full_length, just get sub_idx masks, resize, and continue
+                            if mask.shape[0] >= ad_params["full_length"]:
+                                mask_downsample = torch.Tensor(mask[ad_params["sub_idxs"]])
+                                mask_downsample = F.interpolate(mask_downsample.unsqueeze(1), size=(mask_h, mask_w), mode=mode).squeeze(1)
+                            # otherwise, need to do more to get proper sub_idxs masks
+                            else:
+                                # resize to needed attention size (to save on memory)
+                                mask_downsample = F.interpolate(mask.unsqueeze(1), size=(mask_h, mask_w), mode=mode).squeeze(1)
+                                # check if mask length matches full_length - if not, make it match
+                                if mask_downsample.shape[0] < ad_params["full_length"]:
+                                    mask_downsample = torch.cat((mask_downsample, mask_downsample[-1:].repeat((ad_params["full_length"]-mask_downsample.shape[0], 1, 1))), dim=0)
+                                # if we have too many remove the excess (should not happen, but just in case)
+                                if mask_downsample.shape[0] > ad_params["full_length"]:
+                                    mask_downsample = mask_downsample[:ad_params["full_length"]]
+                                # now, select sub_idxs masks
+                                mask_downsample = mask_downsample[ad_params["sub_idxs"]]
+                        # otherwise, perform usual mask interpolation
+                        else:
+                            mask_downsample = F.interpolate(mask.unsqueeze(1), size=(mask_h, mask_w), mode=mode).squeeze(1)
+
+                        # if we don't have enough masks repeat the last one until we reach the right size
+                        if mask_downsample.shape[0] < batch_prompt:
+                            mask_downsample = torch.cat((mask_downsample, mask_downsample[-1:, :, :].repeat((batch_prompt-mask_downsample.shape[0], 1, 1))), dim=0)
+                        # if we have too many remove the exceeding
+                        elif mask_downsample.shape[0] > batch_prompt:
+                            mask_downsample = mask_downsample[:batch_prompt, :, :]
                 
-                # repeat the masks
-                mask_downsample = mask_downsample.repeat(len(cond_or_uncond), 1, 1)
-                mask_downsample = mask_downsample.view(mask_downsample.shape[0], -1, 1).repeat(1, 1, out.shape[2])
+                        # repeat the masks for each cond_or_uncond chunk, the channels are broadcast by the multiplication
+                        mask_downsample = mask_downsample.unsqueeze(0).expand(len(cond_or_uncond), -1, -1, -1).reshape(b, -1, 1)
 
-                out_ip = out_ip * mask_downsample
+                        self.mask_cache[i] = (mask_key, mask_downsample)
 
-            out = out + out_ip
+                    out_ip = out_ip * self.mask_cache[i][1]
+
+                out = out + out_ip
 
         return out.to(dtype=org_dtype)
 
@@ -602,9 +960,7 @@ class IPAdapterApply:
         clip_extra_context_tokens = 16 if is_plus else 4
 
         if embeds is not None:
-            embeds = torch.unbind(embeds)
-            clip_embed = embeds[0].cpu()
-            clip_embed_zeroed = embeds[1].cpu()
+            clip_embed, clip_embed_zeroed = unpack_embeds(embeds)
         else:
             if is_faceid:
                 insightface.det_model.input_size = (640,640) # reset the detection size
@@ -629,39 +985,19 @@ class IPAdapterApply:
                 face_embed = torch.stack(face_embed, dim=0)
                 image = torch.stack(face_clipvision, dim=0)
 
-                neg_image = image_add_noise(image, noise) if noise > 0 else None
-               
                 if is_plus:
-                    clip_embed = clip_vision.encode_image(image).penultimate_hidden_states
-                    if noise > 0:
-                        clip_embed_zeroed = clip_vision.encode_image(neg_image).penultimate_hidden_states
-                    else:
-                        clip_embed_zeroed = zeroed_hidden_states(clip_vision, image.shape[0])
-                    
+                    clip_embed, clip_embed_zeroed = encode_image_embeds(clip_vision, image, noise, True)
+
                     # TODO: check noise to the uncods too
-                    face_embed_zeroed = torch.zeros_like(face_embed)
+                    face_embed_zeroed = zeros_like_expanded(face_embed)
                 else:
                     clip_embed = face_embed
-                    clip_embed_zeroed = torch.zeros_like(clip_embed)
+                    clip_embed_zeroed = zeros_like_expanded(clip_embed)
             else:
                 if image.shape[1] != image.shape[2]:
                     print("\033[33mINFO: the IPAdapter reference image is not a square, CLIPImageProcessor will resize and crop it at the center. If the main focus of the picture is not in the middle the result might not be what you are expecting.\033[0m")
 
-                clip_embed = clip_vision.encode_image(image)
-                neg_image = image_add_noise(image, noise) if noise > 0 else None
-                
-                if is_plus:
-                    clip_embed = clip_embed.penultimate_hidden_states
-                    if noise > 0:
-                        clip_embed_zeroed = clip_vision.encode_image(neg_image).penultimate_hidden_states
-                    else:
-                        clip_embed_zeroed = zeroed_hidden_states(clip_vision, image.shape[0])
-                else:
-                    clip_embed = clip_embed.image_embeds
-                    if noise > 0:
-                        clip_embed_zeroed = clip_vision.encode_image(neg_image).image_embeds
-                    else:
-                        clip_embed_zeroed = torch.zeros_like(clip_embed)
+                clip_embed, clip_embed_zeroed = encode_image_embeds(clip_vision, image, noise, is_plus)
 
         clip_embeddings_dim = clip_embed.shape[-1]
 
@@ -683,11 +1019,11 @@ class IPAdapterApply:
         sigma_end = model.model.model_sampling.percent_to_sigma(end_at)
 
         if is_faceid and is_plus:
-            image_prompt_embeds = ipadapter_embedder.get_image_embeds_faceid_plus(face_embed, clip_embed, weight_v2, faceid_v2)
-            uncond_image_prompt_embeds = ipadapter_embedder.get_image_embeds_faceid_plus(face_embed_zeroed, clip_embed_zeroed, weight_v2, faceid_v2)
+            image_prompt_embeds, uncond_image_prompt_embeds = ipadapter_embedder.get_image_embeds_faceid_plus(face_embed, clip_embed, face_embed_zeroed, clip_embed_zeroed, weight_v2, faceid_v2)
         else:
             image_prompt_embeds, uncond_image_prompt_embeds = ipadapter_embedder.get_image_embeds(clip_embed, clip_embed_zeroed)
 
+        ipadapter_embedder.offload()
         del ipadapter_embedder
 
         # offload to CPU memory
@@ -697,9 +1033,9 @@ class IPAdapterApply:
         if attn_mask is not None:
             attn_mask = attn_mask.to(model.offload_device)
 
-        ip_layers = To_KV(ipadapter["ip_adapter"])
+        # in low vram mode keep the ip layers in int8, they are only computed once per sampling
+        ip_layers = get_to_kv(ipadapter["ip_adapter"], weight_dtype=torch.int8 if QUANTIZE_WEIGHTS else None)
         patch_kwargs = {
-            "number": 0,
             "weight": weight,
             "ip_layers": ip_layers,
             "cond": image_prompt_embeds,
@@ -713,28 +1049,7 @@ class IPAdapterApply:
 
         work_model = model.clone()
 
-        if not is_sdxl:
-            for id in [1,2,4,5,7,8]: # id of input_blocks that have cross attention
-                set_model_patch_replace(work_model, patch_kwargs, ("input", id))
-                patch_kwargs["number"] += 1
-            for id in [3,4,5,6,7,8,9,10,11]: # id of output_blocks that have cross attention
-                set_model_patch_replace(work_model, patch_kwargs, ("output", id))
-                patch_kwargs["number"] += 1
-            set_model_patch_replace(work_model, patch_kwargs, ("middle", 0))
-        else:
-            for id in [4,5,7,8]: # id of input_blocks that have cross attention
-                block_indices = range(2) if id in [4, 5] else range(10) # transformer_depth
-                for index in block_indices:
-                    set_model_patch_replace(work_model, patch_kwargs, ("input", id, index))
-                    patch_kwargs["number"] += 1
-            for id in range(6): # id of output_blocks that have cross attention
-                block_indices = range(2) if id in [3, 4, 5] else range(10) # transformer_depth
-                for index in block_indices:
-                    set_model_patch_replace(work_model, patch_kwargs, ("output", id, index))
-                    patch_kwargs["number"] += 1
-            for index in range(10):
-                set_model_patch_replace(work_model, patch_kwargs, ("middle", 0, index))
-                patch_kwargs["number"] += 1
+        set_model_patch_replace(work_model, patch_kwargs, SDXL_ATTN2_KEYS if is_sdxl else SD15_ATTN2_KEYS)
 
         return (work_model, )
 
@@ -762,6 +1077,15 @@ class IPAdapterApplyFaceID(IPAdapterApply):
             }
         }
 
+# PIL resampling filters that torch can apply to the whole batch, LANCZOS and HAMMING still go through PIL.
+# "nearest-exact" picks the same source pixel as PIL, "area" is PIL's BOX only for integer downscales
+TORCH_INTERPOLATION = {
+    "BICUBIC": "bicubic",
+    "BILINEAR": "bilinear",
+    "BOX": "area",
+    "NEAREST": "nearest-exact",
+}
+
 def prepImage(image, interpolation="LANCZOS", crop_position="center", size=(224,224), sharpening=0.0, padding=0):
     _, oh, ow, _ = image.shape
     output = image.permute([0,3,1,2])
@@ -792,14 +1116,29 @@ def prepImage(image, interpolation="LANCZOS", crop_position="center", size=(224,
         # crop
         output = output[:, :, y:y2, x:x2]
 
-    # resize (apparently PIL resize is better than tourchvision interpolate)
-    imgs = []
-    for i in range(output.shape[0]):
-        img = TT.ToPILImage()(output[i])
-        img = img.resize(size, resample=Image.Resampling[interpolation])
-        imgs.append(TT.ToTensor()(img))
-    output = torch.stack(imgs, dim=0)
-    imgs = None # zelous GC
+    # resize, the whole batch at once when torch has a matching interpolation
+    mode = TORCH_INTERPOLATION.get(interpolation)
+    if mode == "area" and (output.shape[2] % size[1] != 0 or output.shape[3] % size[0] != 0):
+        mode = None
+
+    if mode is not None:
+        if TF is not None and output.device.type == "cpu" and mode in ["bilinear", "bicubic"]:
+            # on CPU torchvision has much faster antialiased kernels for uint8 images
+            output = output.clamp(0, 1).mul(255).round_().to(torch.uint8)
+            output = TF.resize(output, [size[1], size[0]], interpolation=TT.InterpolationMode[interpolation], antialias=True)
+            output = output.to(torch.float32).div_(255)
+        else:
+            output = F.interpolate(output, size=(size[1], size[0]), mode=mode, antialias=mode in ["bilinear", "bicubic"])
+            output = output.clamp(0, 1)
+    else:
+        # apparently PIL resize is better than tourchvision interpolate
+        imgs = []
+        for i in range(output.shape[0]):
+            img = TT.ToPILImage()(output[i])
+            img = img.resize(size, resample=Image.Resampling[interpolation])
+            imgs.append(TT.ToTensor()(img))
+        output = torch.stack(imgs, dim=0)
+        imgs = None # zelous GC
     
     if sharpening > 0:
         output = contrast_adaptive_sharpening(output, sharpening)
@@ -807,6 +1146,9 @@ def prepImage(image, interpolation="LANCZOS", crop_position="center", size=(224,
     if padding > 0:
         output = F.pad(output, (padding, padding, padding, padding), value=255, mode="constant")
 
+    # the permuted IMAGE input is already channels_last and interpolate keeps that layout, so this is
+    # usually a no-op and the permute back to NHWC returns a contiguous view instead of a strided one
+    output = output.contiguous(memory_format=torch.channels_last)
     output = output.permute([0,2,3,1])
 
     return output
@@ -883,54 +1225,70 @@ class IPAdapterEncoder:
     FUNCTION = "preprocess"
     CATEGORY = "ipadapter"
 
+    @torch.inference_mode()
     def preprocess(self, clip_vision, image_1, ipadapter_plus, noise, weight_1, image_2=None, image_3=None, image_4=None, weight_2=1.0, weight_3=1.0, weight_4=1.0):
-        weight_1 *= (0.1 + (weight_1 - 0.1))
-        weight_2 *= (0.1 + (weight_2 - 0.1))
-        weight_3 *= (0.1 + (weight_3 - 0.1))
-        weight_4 *= (0.1 + (weight_4 - 0.1))
-
-        image = image_1
-        weight = [weight_1]*image_1.shape[0]
-        
-        if image_2 is not None:
-            if image_1.shape[1:] != image_2.shape[1:]:
-                image_2 = comfy.utils.common_upscale(image_2.movedim(-1,1), image.shape[2], image.shape[1], "bilinear", "center").movedim(1,-1)
-            image = torch.cat((image, image_2), dim=0)
-            weight += [weight_2]*image_2.shape[0]
-        if image_3 is not None:
-            if image.shape[1:] != image_3.shape[1:]:
-                image_3 = comfy.utils.common_upscale(image_3.movedim(-1,1), image.shape[2], image.shape[1], "bilinear", "center").movedim(1,-1)
-            image = torch.cat((image, image_3), dim=0)
-            weight += [weight_3]*image_3.shape[0]
-        if image_4 is not None:
-            if image.shape[1:] != image_4.shape[1:]:
-                image_4 = comfy.utils.common_upscale(image_4.movedim(-1,1), image.shape[2], image.shape[1], "bilinear", "center").movedim(1,-1)
-            image = torch.cat((image, image_4), dim=0)
-            weight += [weight_4]*image_4.shape[0]
-        
-        clip_embed = clip_vision.encode_image(image)
-        neg_image = image_add_noise(image, noise) if noise > 0 else None
-        
-        if ipadapter_plus:
-            clip_embed = clip_embed.penultimate_hidden_states
-            if noise > 0:
-                clip_embed_zeroed = clip_vision.encode_image(neg_image).penultimate_hidden_states
-            else:
-                clip_embed_zeroed = zeroed_hidden_states(clip_vision, image.shape[0])
-        else:
-            clip_embed = clip_embed.image_embeds
-            if noise > 0:
-                clip_embed_zeroed = clip_vision.encode_image(neg_image).image_embeds
+        # resize on the clip vision device, encode_image would move the images there anyway
+        device = clip_vision.load_device
+
+        images = []
+        weight = []
+        counts = []
+        for image, image_weight in zip([image_1, image_2, image_3, image_4], [weight_1, weight_2, weight_3, weight_4]):
+            if image is None:
+                continue
+            images.append(image.to(device, non_blocking=True))
+            weight.append(image_weight)
+            counts.append(image.shape[0])
+
+        # the inputs are resized straight to the clip vision input size like clip_preprocess would do (center crop,
+        # antialiased bicubic). Matching the size of image_1 first meant a second resize, one interpolation per size
+        size = getattr(clip_vision, "image_size", 224)
+        groups = {}
+        for i, image in enumerate(images):
+            if image.shape[1:3] != (size, size):
+                groups.setdefault(image.shape[1:], []).append(i)
+        for idxs in groups.values():
+            resized = crop_and_resize(torch.cat([images[i] for i in idxs], dim=0), size, size, mode="bicubic")
+            for i, image in zip(idxs, resized.split([counts[i] for i in idxs], dim=0)):
+                images[i] = image
+            resized = None
+
+        # the same reference is often passed more than once with different weights, it's encoded only once
+        unique = []
+        index = []
+        for image in images:
+            for u, other in enumerate(unique):
+                if image is other or (image.shape == other.shape and torch.equal(image, other)):
+                    break
             else:
-                clip_embed_zeroed = torch.zeros_like(clip_embed)
-
-        if any(e != 1.0 for e in weight):
-            weight = torch.tensor(weight).unsqueeze(-1) if not ipadapter_plus else torch.tensor(weight).unsqueeze(-1).unsqueeze(-1)
-            clip_embed = clip_embed * weight
-        
-        output = torch.stack((clip_embed, clip_embed_zeroed))
-
-        return( output, )
+                u = len(unique)
+                unique.append(image)
+            index.append(u)
+
+        # a single concatenation of all the inputs, none at all for the common single input case
+        image = unique[0] if len(unique) == 1 else torch.cat(unique, dim=0)
+        images = None
+
+        clip_embed, clip_embed_zeroed = encode_image_embeds(clip_vision, image, noise, ipadapter_plus)
+
+        if len(unique) < len(index):
+            # scatter the embeds of the unique inputs back to every input
+            offsets = [0]
+            for u in unique:
+                offsets.append(offsets[-1] + u.shape[0])
+            rows = torch.cat([torch.arange(offsets[u], offsets[u+1]) for u in index]).to(clip_embed.device)
+            clip_embed = clip_embed.index_select(0, rows)
+            clip_embed_zeroed = clip_embed_zeroed.index_select(0, rows.to(clip_embed_zeroed.device))
+        unique = None
+
+        # one weight per input image, squared. The embeds are fresh out of the encoder so they are weighted in place
+        weight = torch.tensor(weight, device=clip_embed.device)
+        weight = weight * weight
+        weight = torch.repeat_interleave(weight, torch.tensor(counts, device=clip_embed.device), output_size=sum(counts))
+        clip_embed.mul_(weight.view(-1, *[1]*(clip_embed.dim() - 1)))
+
+        # cond and uncond are returned as they are, stacking them would only copy both
+        return( (clip_embed, clip_embed_zeroed), )
 
 class IPAdapterApplyEncoded(IPAdapterApply):
     @classmethod
@@ -973,16 +1331,54 @@ class IPAdapterSaveEmbeds:
         file = f"{filename}_{counter:05}_.ipadpt"
         file = os.path.join(full_output_folder, file)
 
-        torch.save(embeds, file)
+        # safetensors content, the extension is kept so the files are listed by IPAdapterLoadEmbeds
+        cond, uncond = unpack_embeds(embeds)
+        safetensors.torch.save_file({"cond": cond.contiguous().cpu(), "uncond": uncond.contiguous().cpu()}, file)
         return (None, )
 
 
+# the .ipadpt files of the input directory, rescanned only when one of the directories changed
+embeds_files_cache = {}
+
+def scan_embeds_files(input_dir):
+    mtimes = {}
+    files = []
+    dirs = [input_dir]
+    while dirs:
+        path = dirs.pop()
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.name.endswith('.ipadpt'):
+                        files.append(os.path.relpath(entry.path, input_dir))
+        except OSError:
+            continue
+    return mtimes, sorted(files)
+
+def get_embeds_files(input_dir):
+    # the mtime of a directory changes when a file is added, removed or renamed in it,
+    # statting the cached directories is much cheaper than listing all the files
+    cached = embeds_files_cache.get(input_dir)
+    if cached is not None:
+        mtimes, files = cached
+        try:
+            if all(os.stat(path).st_mtime_ns == mtime for path, mtime in mtimes.items()):
+                return files
+        except OSError:
+            pass
+
+    embeds_files_cache[input_dir] = scan_embeds_files(input_dir)
+    return embeds_files_cache[input_dir][1]
+
 class IPAdapterLoadEmbeds:
     @classmethod
     def INPUT_TYPES(s):
         input_dir = folder_paths.get_input_directory()
-        files = [os.path.relpath(os.path.join(root, file), input_dir) for root, dirs, files in os.walk(input_dir) for file in files if file.endswith('.ipadpt')]
-        return {"required": {"embeds": [sorted(files), ]}, }
+        files = get_embeds_files(input_dir)
+        return {"required": {"embeds": [files, ]}, }
 
     RETURN_TYPES = ("EMBEDS", )
     FUNCTION = "load"
@@ -990,7 +1386,20 @@ class IPAdapterLoadEmbeds:
 
     def load(self, embeds):
         path = folder_paths.get_annotated_filepath(embeds)
-        output = torch.load(path).cpu()
+        with open(path, "rb") as f:
+            magic = f.read(4)
+
+        if magic == b"PK\x03\x04":
+            # stacked embeds saved with torch.save by previous versions, a zip archive. Safetensors
+            # files start with the length of their header so they never begin with this signature
+            output = unpack_embeds(torch.load(path, map_location="cpu"))
+        else:
+            output = safetensors.torch.load_file(path, device="cpu")
+            output = (output["cond"], output["uncond"]) if "cond" in output else unpack_embeds(output["embeds"])
+
+        # pinned memory so that the copy to the GPU in the apply nodes doesn't block
+        if torch.cuda.is_available():
+            output = tuple(e.pin_memory() for e in output)
 
         return (output, )
 
@@ -998,17 +1407,27 @@ class IPAdapterLoadEmbeds:
 class IPAdapterBatchEmbeds:
     @classmethod
     def INPUT_TYPES(s):
-        return {"required": {
-            "embed1": ("EMBEDS",),
-            "embed2": ("EMBEDS",),
-        }}
+        return {
+            "required": {
+                "embed1": ("EMBEDS",),
+                "embed2": ("EMBEDS",),
+            },
+            "optional": {
+                "embed3": ("EMBEDS",),
+                "embed4": ("EMBEDS",),
+            }
+        }
 
     RETURN_TYPES = ("EMBEDS",)
     FUNCTION = "batch"
     CATEGORY = "ipadapter"
 
-    def batch(self, embed1, embed2):
-        return (torch.cat((embed1, embed2), dim=1), )
+    def batch(self, embed1, embed2, embed3=None, embed4=None):
+        # a single concatenation of all the embeds instead of chaining pairwise batch nodes
+        embeds = [unpack_embeds(e) for e in (embed1, embed2, embed3, embed4) if e is not None]
+        cond = cat_embeds([e[0] for e in embeds])
+        uncond = cat_embeds([e[1] for e in embeds])
+        return ((cond, uncond), )
 
 NODE_CLASS_MAPPINGS = {
     "IPAdapterModelLoader": IPAdapterModelLoader,